@@ -5,6 +5,7 @@ from typing import Pattern
 from tqdm import tqdm
 import pickle
 import numpy as np
+from torch.utils.data import Sampler
 
 def _truncate_seq_tuple(tokens_a, tokens_b, tokens_c, max_length):
     """Truncates a sequence tuple in place to the maximum length."""
@@ -209,4 +210,51 @@ class DialogREDataSet():
         if not id:
             pbar.close()
         print('All {} instances'.format(all_res))
-        return
\ No newline at end of file
+        return
+
+
+class BucketBatchSampler(Sampler):
+    """Groups examples of similar length into batches to minimize padding.
+
+    The indices are split into buckets of bucket_size * batch_size examples,
+    sorted by length within each bucket and cut into batches. With shuffle, the
+    indices are permuted before bucketing and the batch order is shuffled
+    again; without shuffle, buckets keep the dataset order. A bucket_size of
+    None sorts the whole dataset. Callers that need the original order have to
+    restore it from the yielded indices.
+    """
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_size=100, num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        chunk = max(len(indices), 1) if self.bucket_size is None else self.bucket_size * self.batch_size
+        batches = []
+        for s in range(0, len(indices), chunk):
+            bucket = indices[s: s + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += [bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            rng.shuffle(batches)
+        if self.num_replicas > 1:                       # every rank gets the same number of batches
+            batches = batches[: len(batches) // self.num_replicas * self.num_replicas]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        for batch in self._batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size) // self.num_replicas
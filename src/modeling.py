@@ -61,8 +61,8 @@ class BertForSequenceClassificationEntityMax(BERT.BertPreTrainedModel):
         # print('pooled_out', pooled_output.size())   # [bsz, hid_size]
         # exit()
 
-        b_mask = b_mask.unsqueeze(-1).repeat(1, 1, enc_mem.size(-1))
-        c_mask = c_mask.unsqueeze(-1).repeat(1, 1, enc_mem.size(-1))
+        b_mask = b_mask.unsqueeze(-1)
+        c_mask = c_mask.unsqueeze(-1)
         b_pooled = self.dropout_entity(torch.max(enc_mem * b_mask, dim=1).values)       # [bsz, hid_size]
         c_pooled = self.dropout_entity(torch.max(enc_mem * c_mask, dim=1).values)
         # print('b_pooled', b_pooled.size())
@@ -122,8 +122,8 @@ class RobertaForSequenceClassificationEntityMax(roberta.RobertaPreTrainedModel):
         # print('pooled_out', pooled_output.size())   # [bsz, hid_size]
         # exit()
 
-        b_mask = b_mask.unsqueeze(-1).repeat(1, 1, enc_mem.size(-1))
-        c_mask = c_mask.unsqueeze(-1).repeat(1, 1, enc_mem.size(-1))
+        b_mask = b_mask.unsqueeze(-1)
+        c_mask = c_mask.unsqueeze(-1)
         b_pooled = self.dropout_entity(torch.max(enc_mem * b_mask, dim=1).values)       # [bsz, hid_size]
         c_pooled = self.dropout_entity(torch.max(enc_mem * c_mask, dim=1).values)
         # print('b_pooled', b_pooled.size())
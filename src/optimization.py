@@ -17,6 +17,7 @@
 import math
 import torch
 from torch.optim import Optimizer
+from torch.optim.lr_scheduler import LambdaLR
 from torch.nn.utils import clip_grad_norm_
 
 def warmup_cosine(x, warmup=0.002):
@@ -41,6 +42,58 @@ SCHEDULES = {
 }
 
 
+def get_warmup_schedule(optimizer, warmup=-1, t_total=-1, schedule='warmup_linear'):
+    """Builds a LambdaLR applying the BERTAdam learning rate schedule to any optimizer.
+    Params:
+        warmup: portion of t_total for the warmup, -1  means no warmup. Default: -1
+        t_total: total number of training steps for the learning
+            rate schedule, -1  means constant learning rate. Default: -1
+        schedule: schedule to use for the warmup (see above). Default: 'warmup_linear'
+    """
+    if schedule not in SCHEDULES:
+        raise ValueError("Invalid schedule parameter: {}".format(schedule))
+    if not 0.0 <= warmup < 1.0 and not warmup == -1:
+        raise ValueError("Invalid warmup: {} - should be in [0.0, 1.0[ or -1".format(warmup))
+    schedule_fct = SCHEDULES[schedule]
+
+    def lr_lambda(step):
+        if t_total is None or t_total == -1:
+            return 1.0
+        return float(schedule_fct(step / t_total, warmup))
+
+    return LambdaLR(optimizer, lr_lambda)
+
+
+@torch.no_grad()
+def clip_grad_norm_per_tensor_(parameters, max_norm, process_group=None):
+    """Clips every gradient tensor to max_norm on its own, as BERTAdam did inside its update loop.
+    Params:
+        parameters: the parameters, in the same order on every rank
+        max_norm: maximum norm of each gradient tensor
+        process_group: when the gradients are sharded (FSDP), the squared norms of the local
+            shards are summed over this group first. Default: None (gradients are not sharded)
+    """
+    parameters = list(parameters)
+    index = [i for i, p in enumerate(parameters) if p.grad is not None and p.grad.numel() > 0]
+    grads = [parameters[i].grad for i in index]
+    if process_group is None:
+        if not grads:
+            return
+        norms = torch.stack(torch._foreach_norm(grads))
+    else:
+        # a rank may hold no shard of a tensor, so sum squared norms over all parameters.
+        # NCCL only reduces CUDA tensors, offloaded gradients live on the CPU
+        sq_norms = torch.zeros(len(parameters), device=torch.device("cuda", torch.cuda.current_device()))
+        if grads:
+            local = torch.stack(torch._foreach_norm(grads)).float().to(sq_norms.device)
+            sq_norms[index] = local.pow(2)
+        torch.distributed.all_reduce(sq_norms, group=process_group)
+        norms = sq_norms.sqrt()[index]
+    clip_coefs = (max_norm / (norms.float() + 1e-6)).clamp(max=1.0)
+    for grad, clip_coef in zip(grads, clip_coefs.unbind()):
+        grad.mul_(clip_coef.to(grad.device, grad.dtype))
+
+
 class BERTAdam(Optimizer):
     """Implements BERT version of Adam algorithm with weight decay fix (and no ).
     Params:
@@ -87,6 +87,9 @@ def build_parser():
         help="Proportion of training to perform linear learning rate warmup for. "
         "E.g., 0.1 = 10%% of training.",
     )
+    parser.add_argument(
+        "--max_grad_norm", default=1.0, type=float, help="Maximum norm of each gradient tensor, clipped separately (-1 means no clipping)."
+    )
     parser.add_argument(
         "--save_checkpoints_steps",
         default=1000,
@@ -113,19 +116,25 @@ def build_parser():
         "--optimize_on_cpu",
         default=False,
         action="store_true",
-        help="Whether to perform optimization and keep the optimizer averages on CPU",
+        help="Whether to offload the parameters, gradients and optimizer step to CPU with FSDP",
     )
     parser.add_argument(
         "--fp16",
         default=False,
         action="store_true",
-        help="Whether to use 16-bit float precision instead of 32-bit",
+        help="Whether to use 16-bit float mixed precision (autocast) instead of 32-bit",
+    )
+    parser.add_argument(
+        "--bf16",
+        default=False,
+        action="store_true",
+        help="Whether to use bfloat16 mixed precision (autocast) instead of 32-bit",
     )
     parser.add_argument(
         "--loss_scale",
         type=float,
         default=128,
-        help="Loss scaling, positive power of 2 values can improve fp16 convergence.",
+        help="Initial loss scale of the fp16 GradScaler, positive power of 2 values can improve fp16 convergence.",
     )
     parser.add_argument(
         "--resume", default=False, action="store_true", help="Whether to resume the training."
@@ -152,4 +161,18 @@ def build_parser():
     parser.add_argument(
         "--shuffle", default=False, action="store_true", help="Whether to run training."
     )
+    parser.add_argument(
+        "--dump_first_batch",
+        default=False,
+        action="store_true",
+        help="Whether to dump the decoded first training batch to output_dir/dummy.json.",
+    )
+    parser.add_argument("--log_interval", type=int, default=50, help="number of steps between training loss updates")
+    parser.add_argument("--num_workers", type=int, default=4, help="number of worker processes of the training dataloader")
+    parser.add_argument(
+        "--no_compile", default=False, action="store_true", help="Whether not to torch.compile the model for training."
+    )
+    parser.add_argument(
+        "--jit_eval", default=False, action="store_true", help="Whether to run the final predictions with a traced TorchScript model."
+    )
     return parser
\ No newline at end of file
@@ -19,7 +19,10 @@ from __future__ import division
 from __future__ import print_function
 
 import csv
+import functools
+import glob
 import os
+import shutil
 import logging
 import argparse
 import random
@@ -29,12 +32,14 @@ from tqdm import tqdm, trange
 
 import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
-from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import TensorDataset, DataLoader
 from transformers import AutoTokenizer
+from dataset import BucketBatchSampler
 from modeling import BertForSequenceClassificationEntityMax, RobertaForSequenceClassificationEntityMax
 from transformers import BertConfig, RobertaConfig
-from optimization import BERTAdam
+import transformers.models.bert.modeling_bert as BERT
+import transformers.models.roberta.modeling_roberta as roberta
+from optimization import get_warmup_schedule, clip_grad_norm_per_tensor_
 import json
 import re
 import time
@@ -42,177 +47,163 @@ import time
 n_class = 1
 reverse_order = False
 sa_step = False
+DATA_FIELDS = ["input_ids", "input_lens", "input_mask", "segment_ids", "e1_mask", "e2_mask", "label_ids"]
 
 
 def accuracy(out, labels):
-    out = out.reshape(-1)
-    out = 1 / (1 + np.exp(-out))
-    return np.sum((out > 0.5) == (labels > 0.5)) / 36
-
-
-def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
-        Copy the parameters optimized on CPU/RAM back to the model on GPU
+    # sigmoid(x) > 0.5 <=> x > 0, returns a tensor so callers decide when to sync
+    return ((out > 0) == (labels > 0.5)).sum()
+
+
+def f1_eval(probs, examples):
+    T1 = 0.5
+    T2s = np.arange(51) / 100.0
+
+    probs = np.asarray(probs, dtype=np.float32)                     # [N, 36], already sigmoided
+    labels = np.asarray(examples[6]) == 1                           # [N, 36]
+    assert labels.shape[1] == 36
+    assert len(labels) == len(probs)
+
+    # predictions above T1 do not depend on T2
+    sel = probs > T1
+    correct_sel = np.logical_and(sel, labels).sum()
+    all_sel = sel.sum()
+
+    # rows without any prediction above T1 fall back to the argmax class if its score exceeds T2
+    max_j = probs.argmax(1)
+    max_l = probs.max(1)
+    max_correct = labels[np.arange(len(labels)), max_j]
+    fallback = np.logical_and(~sel.any(1)[None, :], max_l[None, :] > T2s[:, None])    # [51, N]
+
+    correct_sys = correct_sel + np.logical_and(fallback, max_correct[None, :]).sum(1)
+    all_sys = all_sel + fallback.sum(1)
+    correct_gt = labels.sum()
+
+    precision = np.where(all_sys == 0, 1.0, correct_sys / np.maximum(all_sys, 1))
+    recall = np.zeros_like(precision) if correct_gt == 0 else correct_sys / correct_gt
+    denom = precision + recall
+    f_1 = np.where(denom != 0, 2 * precision * recall / np.where(denom != 0, denom, 1), 0.0)
+
+    best = int(f_1.argmax())
+    if f_1[best] <= 0:
+        return 0, 0
+    return float(f_1[best]), float(T2s[best])
+
+
+def trace_for_inference(model, example_batch, weights_file, traced_file):
+    """ Trace and freeze an eval-mode model for inference and save it to traced_file.
+        The saved graph is reused as long as it is newer than weights_file.
+        The transformers encoders cannot be scripted, so the graph is recorded by
+        tracing one example batch; it does not depend on the batch or sequence length.
     """
-    for (name_opti, param_opti), (name_model, param_model) in zip(
-        named_params_optimizer, named_params_model
-    ):
-        if name_opti != name_model:
-            logger.error("name_opti != name_model: {} {}".format(name_opti, name_model))
-            raise ValueError
-        param_model.data.copy_(param_opti.data)
-
-
-def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
-        Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
-    """
-    is_nan = False
-    for (name_opti, param_opti), (name_model, param_model) in zip(
-        named_params_optimizer, named_params_model
-    ):
-        if name_opti != name_model:
-            logger.error("name_opti != name_model: {} {}".format(name_opti, name_model))
-            raise ValueError
-        if test_nan and torch.isnan(param_model.grad).sum() > 0:
-            is_nan = True
-        if param_opti.grad is None:
-            param_opti.grad = torch.nn.Parameter(
-                param_opti.data.new().resize_(*param_opti.data.size())
-            )
-        param_opti.grad.data.copy_(param_model.grad.data)
-    return is_nan
-
-
-def f1_eval(logits, examples):
-    def getpred(result, T1=0.5, T2=0.4):
-        ret = []
-        for i in range(len(result)):
-            r = []
-            maxl, maxj = -1, -1
-            for j in range(len(result[i])):
-                if result[i][j] > T1:
-                    r += [j]
-                if result[i][j] > maxl:
-                    maxl = result[i][j]
-                    maxj = j
-            if len(r) == 0:
-                if maxl <= T2:
-                    r = [36]
-                else:
-                    r += [maxj]
-            ret += [r]
-        return ret
-
-    def geteval(devp, data):
-        correct_sys, all_sys = 0, 0
-        correct_gt = 0
-
-        for i in range(len(data)):
-            for id in data[i]:
-                if id != 36:
-                    correct_gt += 1
-                    if id in devp[i]:
-                        correct_sys += 1
-
-            for id in devp[i]:
-                if id != 36:
-                    all_sys += 1
-
-        precision = 1 if all_sys == 0 else correct_sys / all_sys
-        recall = 0 if correct_gt == 0 else correct_sys / correct_gt
-        f_1 = 2 * precision * recall / (precision + recall) if precision + recall != 0 else 0
-        return f_1
-
-    logits = np.asarray(logits)
-    logits = list(1 / (1 + np.exp(-logits)))
-
-    labels = []
-    label_id_lst = examples[6]
-    for idx in range(len(label_id_lst)):
-        label = []
-        # _, _, _, _, _, _, label_id = examples.__getitem__(idx)
-        label_id = label_id_lst[idx]
-        assert len(label_id) == 36
-        for i in range(36):
-            if label_id[i] == 1:
-                label += [i]
-        if len(label) == 0:
-            label = [36]
-        labels += [label]
-    assert len(labels) == len(logits)
-
-    bestT2 = bestf_1 = 0
-    for T2 in range(51):
-        devp = getpred(logits, T2=T2 / 100.0)
-        f_1 = geteval(devp, labels)
-        if f_1 > bestf_1:
-            bestf_1 = f_1
-            bestT2 = T2 / 100.0
-
-    return bestf_1, bestT2
+    if os.path.exists(traced_file) and os.path.getmtime(traced_file) >= os.path.getmtime(weights_file):
+        print(f"Loading traced model from {traced_file}...")
+        return torch.jit.load(traced_file, map_location=device)
+
+    input_ids, _, input_mask, segment_ids, e1_mask, e2_mask, label_ids = (t.to(device) for t in example_batch)
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), (input_ids, segment_ids, input_mask, label_ids, e1_mask, e2_mask))
+        traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    # write to a temporary file first so that an interrupted run never leaves a truncated graph behind
+    traced.save(traced_file + ".tmp")
+    os.replace(traced_file + ".tmp", traced_file)
+    return traced
 
 
 def datset_collate_fn(samples, device=torch.device("cpu")):
-    # print('Samples:', len(samples), samples)
-    # exit()
-    input_ids = torch.stack([itm[0] for itm in samples], dim=0)
-    input_lens = torch.stack([itm[1] for itm in samples], dim=0)
+    # padding only ever follows the real tokens, so crop every sequence to the longest one in the batch
     input_mask = torch.stack([itm[2] for itm in samples], dim=0)
-    segment_ids = torch.stack([itm[3] for itm in samples], dim=0)
-    e1_mask = torch.stack([itm[4] for itm in samples], dim=0)
-    e2_mask = torch.stack([itm[5] for itm in samples], dim=0)
+    max_len = int(input_mask.sum(dim=1).max())
+    input_ids = torch.stack([itm[0][:max_len] for itm in samples], dim=0)
+    input_lens = torch.stack([itm[1] for itm in samples], dim=0)
+    segment_ids = torch.stack([itm[3][:max_len] for itm in samples], dim=0)
+    e1_mask = torch.stack([itm[4][:max_len] for itm in samples], dim=0)
+    e2_mask = torch.stack([itm[5][:max_len] for itm in samples], dim=0)
     label_ids = torch.stack([itm[6] for itm in samples], dim=0)
-    keep_column_mask = input_ids.ne(tokenizer.pad_token_id).any(dim=0)
-    # print('inp_ids', input_ids[:, keep_column_mask].size())
-    return (input_ids[:, keep_column_mask], input_lens, input_mask[:, keep_column_mask], segment_ids[:, keep_column_mask], e1_mask[:, keep_column_mask], e2_mask[:, keep_column_mask], label_ids)
+    return (input_ids, input_lens, input_mask[:, :max_len], segment_ids, e1_mask, e2_mask, label_ids)
 
 def get_dataloader(data_set, args, batch_size, datatype="train"):
-    tensor_word_inp = torch.tensor(data_set[0], dtype=torch.long)
-    tensor_context_len = torch.tensor(data_set[1], dtype=torch.long)
-    tensor_inp_mask = torch.tensor(data_set[2], dtype=torch.long)
-    tensor_seg_mask = torch.tensor(data_set[3], dtype=torch.long)
-    tensor_e1_mask = torch.tensor(data_set[4], dtype=torch.long)
-    tensor_e2_mask = torch.tensor(data_set[5], dtype=torch.long)
-    tensor_rid = torch.tensor(data_set[6], dtype=torch.float)
-
-    data = TensorDataset(
-        tensor_word_inp,
-        tensor_context_len,
-        tensor_inp_mask,
-        tensor_seg_mask,
-        tensor_e1_mask,
-        tensor_e2_mask,
-        tensor_rid,
+    data = TensorDataset(*data_set)
+    # only the train loader is iterated every epoch; eval loaders load in the main process
+    num_workers = args.num_workers if datatype == "train" else 0
+    loader_kwargs = dict(
+        collate_fn=datset_collate_fn,
+        num_workers=num_workers,
+        persistent_workers=num_workers > 0,
+        pin_memory=torch.cuda.is_available() and not args.no_cuda,
     )
-    # if args.local_rank == -1:
-    #     sampler = SequentialSampler(data)
-    # else:
-    #     sampler = DistributedSampler(data)
-    if datatype == "train" and args.shuffle:
-        dataloader = DataLoader(data, batch_size=batch_size, shuffle=True, collate_fn=datset_collate_fn)
+    # sequence lengths including the entity part, input_lens only covers the dialogue
+    seq_lens = data_set[2].sum(dim=1).numpy()
+    # training is bucketed by length, evaluation is sorted over the whole set
+    if datatype == "train" and args.local_rank != -1:
+        batch_sampler = BucketBatchSampler(
+            seq_lens,
+            batch_size,
+            shuffle=args.shuffle,
+            num_replicas=torch.distributed.get_world_size(),
+            rank=torch.distributed.get_rank(),
+            seed=args.seed,
+        )
     else:
-        dataloader = DataLoader(data, batch_size=batch_size, shuffle=False, collate_fn=datset_collate_fn)
+        batch_sampler = BucketBatchSampler(
+            seq_lens,
+            batch_size,
+            shuffle=datatype == "train" and args.shuffle,
+            bucket_size=100 if datatype == "train" else None,
+            seed=args.seed,
+        )
+    dataloader = DataLoader(data, batch_sampler=batch_sampler, **loader_kwargs)
     return dataloader
 
 
+def get_data_bin_pickles(args, datatype="train"):
+    max_split = 10
+    pkl_files = [args.save_data + "/{}-{}.pkl".format(datatype, idx) for idx in range(max_split)]
+    return [pkl_file for pkl_file in pkl_files if os.path.exists(pkl_file)]
+
+
+def convert_data_bin(args, pkl_files, data_file):
+    """ Concatenate the pickled splits written by preprocess.py into a single
+        tensor file so that later runs can load (and memory-map) it directly.
+    """
+    data_set = [[] for _ in range(len(DATA_FIELDS))]
+    for pkl_file in pkl_files:
+        print('Loading data-bin from', pkl_file)
+        with open(pkl_file, "rb") as f:
+            ith_data_set = pickle.load(f)
+        print(len(ith_data_set), len(ith_data_set[0]), len(ith_data_set[1]))
+        for i in range(len(data_set)):
+            data_set[i].extend(ith_data_set[i])
+    if len(data_set[0]) == 0:
+        raise ValueError("No instances found in {}".format(", ".join(pkl_files)))
+
+    blob = {
+        name: torch.from_numpy(np.asarray(field, dtype=np.float32 if name == "label_ids" else np.int64))
+        for name, field in zip(DATA_FIELDS, data_set)
+    }
+    # write to a temporary file first so that a crash never leaves a truncated cache behind
+    torch.save(blob, data_file + ".tmp")
+    os.replace(data_file + ".tmp", data_file)
+
+
 def build_dataloader(args, datatype="train"):
     assert datatype in ["train", "dev", "test"] or datatype.startswith("devc") or datatype.startswith("testc"), "Invalid dataset type: " + datatype
-    max_split = 10
-    data_set = [[] for _ in range(7)]
-    for idx in range(max_split):
-        if os.path.exists(args.save_data + "/{}-{}.pkl".format(datatype, idx)):
-            print('Loading data-bin from', args.save_data + f"/{datatype}-{idx}.pkl")
-            ith_data_set = pickle.load(
-                open(args.save_data + "/{}-{}.pkl".format(datatype, idx), "rb")
-            )
-            print(len(ith_data_set), len(ith_data_set[0]), len(ith_data_set[1]))
-            data_set = [data_set[i] + ith_data_set[i] for i in range(len(data_set))]
-        else:
-            pass
-            # print(
-            #     "{} not exists.".format((args.save_data + "/" + datatype + "-" + str(idx) + ".pkl"))
-            # )
+    data_file = args.save_data + "/{}.pt".format(datatype)
+    pkl_files = get_data_bin_pickles(args, datatype)
+    if not pkl_files and not os.path.exists(data_file):
+        raise ValueError("No preprocessed {} data found in {}, run preprocess.sh first.".format(datatype, args.save_data))
+    # rebuild the cache whenever preprocess.py has written newer pickles
+    stale = bool(pkl_files) and (
+        not os.path.exists(data_file)
+        or max(os.path.getmtime(pkl_file) for pkl_file in pkl_files) > os.path.getmtime(data_file)
+    )
+    if broadcast_from_main(stale):
+        if is_main_process:
+            convert_data_bin(args, pkl_files, data_file)
+        barrier()
+    print('Loading data-bin from', data_file)
+    blob = torch.load(data_file, map_location="cpu", mmap=True)
+    data_set = [blob[name] for name in DATA_FIELDS]
     print("concatted dataset:{}x{}".format(len(data_set), len(data_set[0])))
     batch_size = args.train_batch_size if datatype == "train" else args.eval_batch_size
     data_loader = get_dataloader(data_set, args, batch_size, datatype)
@@ -221,11 +212,12 @@ def build_dataloader(args, datatype="train"):
 
 
 def train(model, examples, dataloader, global_step, epoch):
-    tr_loss = 0
+    tr_loss = torch.zeros((), device=device)
+    log_loss = torch.zeros((), device=device)
     nb_tr_examples, nb_tr_steps = 0, 0
     epoch_iterator = tqdm(dataloader, desc="Iteration {}".format(epoch))
     for step, batch in enumerate(epoch_iterator):
-        batch = tuple(t.to(device) for t in batch)
+        batch = tuple(t.to(device, non_blocking=True) for t in batch)
         (
             input_ids,
             input_len,
@@ -235,10 +227,12 @@ def train(model, examples, dataloader, global_step, epoch):
             e2_mask,
             label_ids,
         ) = batch
-        if epoch == 1 and step == 0:
+        if args.dump_first_batch and epoch == 1 and step == 0:
             src_ids = input_ids.squeeze(1).tolist()
             # print('Src_ids', input_ids.squeeze(1).size())
-            src_str = tokenizer.batch_decode(src_ids)
+            if not tokenizer.is_fast:
+                logger.warning("Decoding the first batch with a slow tokenizer")
+            src_str = tokenizer.batch_decode(src_ids, skip_special_tokens=False)
             e1_ids = e1_mask.tolist()
             e2_ids = e2_mask.tolist()
             inp_mask = input_mask.tolist()
@@ -246,49 +240,38 @@ def train(model, examples, dataloader, global_step, epoch):
                 tmp={'src_ids':str(src_ids), 'src_str':src_str, 'attention_mask':str(inp_mask), 'e1_mask': str(e1_ids), 'e2_mask': str(e2_ids)}
                 json.dump(tmp, fout, indent=4)
 
-        loss, _ = model(
-            input_ids=input_ids,
-            token_type_ids=segment_ids,
-            attention_mask=input_mask,
-            labels=label_ids.float(),
-            b_mask=e1_mask,
-            c_mask=e2_mask
-        )
-        if n_gpu > 1:
-            loss = loss.mean()
-        if args.fp16 and args.loss_scale != 1.0:
-            # rescale loss for fp16 training
-            # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-            loss = loss * args.loss_scale
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            loss, _ = model(
+                input_ids=input_ids,
+                token_type_ids=segment_ids,
+                attention_mask=input_mask,
+                labels=label_ids,
+                b_mask=e1_mask,
+                c_mask=e2_mask
+            )
         if args.gradient_accumulation_steps > 1:
             loss = loss / args.gradient_accumulation_steps
-        epoch_iterator.set_postfix(loss=loss.item(), lr=optimizer.get_lr()[0])
-        loss.backward()
-        tr_loss += loss.item()
+        scaler.scale(loss).backward()
+        tr_loss += loss.detach()
+        log_loss += loss.detach()
         nb_tr_examples += input_ids.size(0)
         nb_tr_steps += 1
+        if nb_tr_steps % args.log_interval == 0:
+            # reading the loss back synchronizes with the device, so only do it every log_interval steps
+            epoch_iterator.set_postfix(loss=(log_loss / args.log_interval).item(), lr=optimizer.param_groups[0]['lr'])
+            log_loss.zero_()
         if (step + 1) % args.gradient_accumulation_steps == 0:
-            if args.fp16 or args.optimize_on_cpu:
-                if args.fp16 and args.loss_scale != 1.0:
-                    # scale down gradients for fp16 training
-                    for param in model.parameters():
-                        param.grad.data = param.grad.data / args.loss_scale
-                is_nan = set_optimizer_params_grad(
-                    param_optimizer, model.named_parameters(), test_nan=True
-                )
-                if is_nan:
-                    logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                    args.loss_scale = args.loss_scale / 2
-                    model.zero_grad()
-                    continue
-                optimizer.step()
-                copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
-            else:
-                optimizer.step()
-            model.zero_grad()
+            # unscale before clipping the gradient norm; steps with inf/nan gradients are skipped
+            scaler.unscale_(optimizer)
+            if args.max_grad_norm > 0:
+                clip_grad_norm(args.max_grad_norm)
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            model.zero_grad(set_to_none=True)
             global_step += 1
 
-    result = {"train_loss": tr_loss / nb_tr_steps, "global_step": global_step}
+    result = {"train_loss": tr_loss.item() / nb_tr_steps, "global_step": global_step}
     return result
 
 
@@ -297,11 +280,14 @@ def evaluate(model, examples, dataloader, datatype='dev'):
     logger.info("  Num examples = %d", len(examples[0]))
     logger.info("  Batch size = %d", args.eval_batch_size)
 
-    eval_loss, eval_accuracy = 0, 0
+    eval_loss = torch.zeros((), device=device)
+    eval_correct = torch.zeros((), dtype=torch.long, device=device)
     nb_eval_steps, nb_eval_examples = 0, 0
-    logits_all = []
+    logits_all = torch.empty(
+        (len(examples[0]), args.num_labels), dtype=torch.float32, pin_memory=device.type == "cuda"
+    )
     for batch in dataloader:
-        batch = tuple(t.to(device) for t in batch)
+        batch = tuple(t.to(device, non_blocking=True) for t in batch)
         (
             input_ids,
             input_len,
@@ -311,37 +297,39 @@ def evaluate(model, examples, dataloader, datatype='dev'):
             e2_mask,
             label_ids
         ) = batch
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
             tmp_eval_loss, logits = model(
                 input_ids=input_ids,
                 token_type_ids=segment_ids,
                 attention_mask=input_mask,
-                labels=label_ids.float(),
+                labels=label_ids,
                 b_mask=e1_mask,
                 c_mask=e2_mask
             )
 
-        logits = logits.detach().cpu().numpy()
-        label_ids = label_ids.to("cpu").numpy()
-        for i in range(len(logits)):
-            logits_all += [logits[i]]
+        logits = logits.detach().float()
+        logits_all[nb_eval_examples:nb_eval_examples + logits.size(0)].copy_(logits, non_blocking=True)
 
-        tmp_eval_accuracy = accuracy(logits, label_ids.reshape(-1))
-        eval_accuracy += tmp_eval_accuracy
-        eval_loss += tmp_eval_loss.mean().item()
+        eval_correct += accuracy(logits, label_ids)
+        eval_loss += tmp_eval_loss.detach().mean()
         nb_eval_examples += input_ids.size(0)
         nb_eval_steps += 1
 
-    eval_loss = eval_loss / nb_eval_steps
-    eval_accuracy = eval_accuracy / nb_eval_examples
+    eval_loss = eval_loss.item() / nb_eval_steps
+    eval_accuracy = eval_correct.item() / 36 / nb_eval_examples
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    # batches are length-sorted, put the logits back in example order
+    order = torch.from_numpy(np.argsort(np.concatenate(list(dataloader.batch_sampler))))
+    logits_all = logits_all[order]
     result = {"eval_loss": eval_loss, "eval_acc": eval_accuracy}
 
     if args.f1eval:
-        eval_f1, eval_T2 = f1_eval(logits_all, examples)
+        eval_f1, eval_T2 = f1_eval(torch.sigmoid(logits_all).numpy(), examples)
         result["f1"] = eval_f1
         result["T2"] = eval_T2
 
-    return result, eval_accuracy, logits_all
+    return result, eval_accuracy, logits_all.numpy()
 
 
 parser = build_parser()
@@ -356,21 +344,49 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# one process per GPU, e.g. torchrun --nproc_per_node=NUM_GPUS run.py ...
+if args.local_rank == -1:
+    args.local_rank = int(os.environ.get("LOCAL_RANK", -1))
+
 if args.local_rank == -1 or args.no_cuda:
     device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-    n_gpu = torch.cuda.device_count()
+    n_gpu = 1 if device.type == "cuda" else 0
+    if torch.cuda.device_count() > 1 and not args.no_cuda:
+        logger.info("Using a single GPU, launch with torchrun for multi-GPU training")
 else:
+    torch.cuda.set_device(args.local_rank)
     device = torch.device("cuda", args.local_rank)
     n_gpu = 1
     # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
     torch.distributed.init_process_group(backend="nccl")
-    if args.fp16:
-        logger.info("16-bits training currently not supported in distributed training")
-        args.fp16 = False  # (see https://github.com/pytorch/pytorch/pull/13496)
 
 logger.info(
     "device %s n_gpu %d distributed training %r", device, n_gpu, bool(args.local_rank != -1)
 )
+# checkpoints, evaluation and prediction files are handled by the first process only
+is_main_process = args.local_rank in [-1, 0]
+
+
+def barrier():
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.barrier()
+
+
+def broadcast_from_main(obj):
+    # ranks that decide on their own whether to enter a collective can disagree and deadlock,
+    # so the first process decides for all of them
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        objs = [obj]
+        torch.distributed.broadcast_object_list(objs, src=0)
+        obj = objs[0]
+    return obj
+
+
+def save_checkpoint(model, file_name):
+    # state_dict() is collective under FSDP, so it runs on every calling rank
+    state_dict = model.state_dict()
+    if is_main_process:
+        torch.save(state_dict, os.path.join(args.output_dir, file_name))
 
 if args.gradient_accumulation_steps < 1:
     raise ValueError(
@@ -379,6 +395,24 @@ if args.gradient_accumulation_steps < 1:
         )
     )
 
+if args.optimize_on_cpu and args.no_cuda:
+    raise ValueError("`optimize_on_cpu` offloads a GPU model with FSDP and cannot be combined with `no_cuda`.")
+
+if args.jit_eval and not args.do_eval:
+    raise ValueError("`jit_eval` traces the model on a dev batch and needs `do_eval`.")
+
+if args.jit_eval and args.optimize_on_cpu:
+    raise ValueError("`jit_eval` cannot trace a model sharded with `optimize_on_cpu`.")
+
+if args.log_interval < 1:
+    raise ValueError("Invalid log_interval parameter: {}, should be >= 1".format(args.log_interval))
+
+if args.fp16 and args.bf16:
+    raise ValueError("Only one of `fp16` or `bf16` can be set.")
+
+# bf16 has the fp32 exponent range, so it runs without loss scaling
+amp_dtype = torch.float16 if args.fp16 else torch.bfloat16 if args.bf16 else None
+
 args.train_batch_size = int(args.train_batch_size / args.gradient_accumulation_steps)
 
 random.seed(args.seed)
@@ -413,6 +447,9 @@ if args.do_train:
         / args.gradient_accumulation_steps
         * args.num_train_epochs
     )
+    if args.local_rank != -1:
+        # every rank only sees its own shard of the batches
+        num_train_steps = int(num_train_steps / torch.distributed.get_world_size())
 
 assert args.architecture in ['STD'], 'Invalid model type : {}'.format(args.model_type)
 
@@ -437,23 +474,16 @@ if args.architecture == 'STD':
 else:
     print('Invalid Model Architecture!!!')
 
+tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=True)
 if "roberta" in args.model_name_or_path:
-    from transformers import RobertaTokenizer
-    tokenizer = RobertaTokenizer.from_pretrained(args.model_name_or_path)
     tokenizer.add_special_tokens({"additional_special_tokens": ["madeupword0001", "madeupword0002"]})
-
 elif "bert" in args.model_name_or_path:
-    from transformers import BertTokenizer
-    tokenizer = BertTokenizer.from_pretrained(args.model_name_or_path)
-    tokenizer.add_special_tokens({"additional_special_tokens": ["[unused1]", "[unused2]"] })
+    tokenizer.add_special_tokens({"additional_special_tokens": ["[unused1]", "[unused2]"]})
 else:
     print(f"{args.model_name_or_path} is not supported, consider BERT or Roberta")
 
 model.resize_token_embeddings(len(tokenizer))
 
-if args.fp16:
-    model.half()
-
 print(model)
 print(
     "num. model params: {} (num. trained: {})".format(
@@ -469,47 +499,89 @@ logger.info(
     )
 )
 
-model.to(device)
-
-if args.local_rank != -1:
-    model = torch.nn.parallel.DistributedDataParallel(
-        model, device_ids=[args.local_rank], output_device=args.local_rank
+if args.optimize_on_cpu:
+    # FSDP keeps the parameters on CPU and streams them to the GPU for each forward/backward
+    from torch.distributed.fsdp import FullyShardedDataParallel, CPUOffload, MixedPrecision
+    from torch.distributed.fsdp.wrap import transformer_auto_wrap_policy
+
+    if not torch.distributed.is_initialized():
+        os.environ.setdefault("MASTER_ADDR", "localhost")
+        os.environ.setdefault("MASTER_PORT", "29500")
+        torch.distributed.init_process_group(backend="nccl", rank=0, world_size=1)
+    model = FullyShardedDataParallel(
+        model,
+        device_id=device,
+        # one FSDP unit per encoder layer, so each layer is fetched (and prefetched) on its own
+        auto_wrap_policy=functools.partial(
+            transformer_auto_wrap_policy,
+            transformer_layer_cls={BERT.BertLayer, roberta.RobertaLayer},
+        ),
+        cpu_offload=CPUOffload(offload_params=True),
+        mixed_precision=MixedPrecision(param_dtype=amp_dtype) if amp_dtype is not None else None,
+        use_orig_params=True,
     )
-elif n_gpu > 1:
-    model = torch.nn.DataParallel(model)
-
-if args.fp16:
-    param_optimizer = [
-        (n, param.clone().detach().to("cpu").float().requires_grad_())
-        for n, param in model.named_parameters()
-    ]
-elif args.optimize_on_cpu:
-    param_optimizer = [
-        (n, param.clone().detach().to("cpu").requires_grad_())
-        for n, param in model.named_parameters()
-    ]
 else:
-    param_optimizer = list(model.named_parameters())
+    model.to(device)
+    if args.local_rank != -1:
+        model = torch.nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[args.local_rank],
+            output_device=args.local_rank,
+            gradient_as_bucket_view=True,
+            static_graph=True,
+        )
+
+# unwrapped model for state dicts and single-process evaluation, so checkpoint keys carry no `module.` prefix
+raw_model = model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+# each gradient tensor is clipped on its own, like BERTAdam did. FSDP shards the gradients,
+# so the squared norms of the local shards are summed over the ranks first
+clip_grad_norm = functools.partial(
+    clip_grad_norm_per_tensor_,
+    list(model.parameters()),
+    process_group=torch.distributed.group.WORLD if args.optimize_on_cpu else None,
+)
+
+# training forwards go through the compiled wrapper, state dicts and the optimizer keep using `model`.
+# The default mode avoids recording a CUDA graph per distinct batch length, and evaluation runs
+# uncompiled since batch-size-1 eval would mostly pay for recompiles.
+compiled_model = model
+if not args.no_compile:
+    compiled_model = torch.compile(model, mode="default", fullgraph=False, dynamic=True)
+
+param_optimizer = list(model.named_parameters())
 
 no_decay = ["bias", "gamma", "beta"]
 
 optimizer_grouped_parameters = [
-    {"params": [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], "weight_decay_rate": 0.01},
-    {"params": [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], "weight_decay_rate": 0.0},
+    {"params": [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], "weight_decay": 0.01},
+    {"params": [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
 ]
 # print('Optimizer grouped params:', optimizer_grouped_parameters)
 
-optimizer = BERTAdam(
+# multi-tensor AdamW; the fused CUDA kernel needs all parameters on GPU
+optimizer = torch.optim.AdamW(
     optimizer_grouped_parameters,
     lr=args.learning_rate,
+    eps=1e-6,
+    **({"fused": True} if device.type == "cuda" and not args.optimize_on_cpu else {"foreach": True})
+)
+scheduler = get_warmup_schedule(
+    optimizer,
     warmup=args.warmup_proportion,
     t_total=num_train_steps,
 )
+# keep fp32 master weights; fp16/bf16 only run inside autocast
+if args.optimize_on_cpu:
+    from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
+    scaler = ShardedGradScaler(init_scale=args.loss_scale, enabled=args.fp16)
+else:
+    scaler = torch.cuda.amp.GradScaler(init_scale=args.loss_scale, enabled=args.fp16)
 
 global_step = 0
 
 if args.resume:
-    model.load_state_dict(torch.load(os.path.join(args.output_dir, "model.pt")))
+    raw_model.load_state_dict(torch.load(os.path.join(args.output_dir, "model.pt"), map_location="cpu"))
 
 if args.do_eval:
     print("Loading dev Set ...")
@@ -534,33 +606,49 @@ if args.do_train:
     for epoch_idx in trange(int(args.num_train_epochs), desc="Epoch"):
 
         model.train()
-        train_result = train(model, train_examples, train_dataloader, global_step, epoch_idx + 1)
+        train_dataloader.batch_sampler.set_epoch(epoch_idx)
+        train_result = train(compiled_model, train_examples, train_dataloader, global_step, epoch_idx + 1)
         logger.info("***** Train results of epoch {}*****".format(epoch_idx + 1))
         for key in sorted(train_result.keys()):
             logger.info("  %s = %s", key, str(train_result[key]))
 
         model.eval()
-        val_result, eval_accuracy, _ = evaluate(model, dev_examples, dev_dataloader, 'dev')
-        logger.info("***** Valid results of epoch {}*****".format(epoch_idx + 1))
-        for key in sorted(val_result.keys()):
-            logger.info("  %s = %s", key, str(val_result[key]))
-
-        if args.f1eval:
-            eval_f1, eval_T2 = val_result["f1"], val_result["T2"]
-            if eval_f1 >= best_metric:
-                torch.save(model.state_dict(), os.path.join(args.output_dir, "model_best.pt"))
-                best_metric = eval_f1
-        else:
-            if eval_accuracy >= best_metric:
-                torch.save(model.state_dict(), os.path.join(args.output_dir, "model_best.pt"))
-                best_metric = eval_accuracy
-
-    model.load_state_dict(torch.load(os.path.join(args.output_dir, "model_best.pt")))
-    torch.save(model.state_dict(), os.path.join(args.output_dir, "model.pt"))
+        # FSDP forwards and state_dict() gather the parameters from every rank, so all ranks evaluate
+        if is_main_process or args.optimize_on_cpu:
+            val_result, eval_accuracy, _ = evaluate(raw_model, dev_examples, dev_dataloader, 'dev')
+            logger.info("***** Valid results of epoch {}*****".format(epoch_idx + 1))
+            for key in sorted(val_result.keys()):
+                logger.info("  %s = %s", key, str(val_result[key]))
+
+            if args.f1eval:
+                eval_f1, eval_T2 = val_result["f1"], val_result["T2"]
+                eval_metric = eval_f1
+            else:
+                eval_metric = eval_accuracy
+            # saving is collective under FSDP, so every rank follows the first process's metric
+            eval_metric = broadcast_from_main(eval_metric) if args.optimize_on_cpu else eval_metric
+            if eval_metric >= best_metric:
+                save_checkpoint(raw_model, "model_best.pt")
+                best_metric = eval_metric
+        barrier()
+
+    raw_model.load_state_dict(torch.load(os.path.join(args.output_dir, "model_best.pt"), map_location="cpu"))
+    save_checkpoint(raw_model, "model.pt")
+    barrier()
 
 print(f"Loading trained weights from {os.path.join(args.output_dir, 'model.pt')}...")
-model.load_state_dict(torch.load(os.path.join(args.output_dir, "model.pt")))
+raw_model.load_state_dict(torch.load(os.path.join(args.output_dir, "model.pt"), map_location="cpu"))
 model.eval()
+if args.jit_eval and is_main_process:
+    eval_model = trace_for_inference(
+        raw_model,
+        next(iter(dev_dataloader)),
+        os.path.join(args.output_dir, "model.pt"),
+        # frozen graphs embed device-specific constants and kernels
+        os.path.join(args.output_dir, "model_traced_{}.pt".format(device.type)),
+    )
+else:
+    eval_model = raw_model
 
 
 def export_predictions(args, data_type='dev', examples=None, dataloader=None):
@@ -570,9 +658,11 @@ def export_predictions(args, data_type='dev', examples=None, dataloader=None):
         print(f'Loading {data_type} data...')
         examples, dataloader = build_dataloader(args, datatype=data_type)
     print("Loading {} Set takes {:.3f}s".format(data_type, time.time() - s_time))
-    eval_result, eval_accuracy, logits_all = evaluate(model, examples, dataloader, data_type)
+    eval_result, eval_accuracy, logits_all = evaluate(eval_model, examples, dataloader, data_type)
     for key in sorted(eval_result.keys()):
         logger.info("  %s = %s", key, str(eval_result[key]))
+    if not is_main_process:
+        return
     output_file = os.path.join(args.output_dir, "logits_{}.txt".format(data_type))
     with open(output_file, "w") as f:
         for i in range(len(logits_all)):
@@ -583,16 +673,28 @@ def export_predictions(args, data_type='dev', examples=None, dataloader=None):
                 else:
                     f.write(" ")
 
-if args.do_eval:
+def concat_files(pattern, output_file):
+    """ Concatenate the files matching pattern (in sorted order) into output_file. """
+    input_files = sorted(glob.glob(pattern))
+    if not input_files:
+        return
+    with open(output_file, "wb") as fout:
+        for input_file in input_files:
+            with open(input_file, "rb") as fin:
+                shutil.copyfileobj(fin, fout)
+
+if args.do_eval and (is_main_process or args.optimize_on_cpu):
     print('Evaluating on dev set...')
     export_predictions(args, 'dev', examples=dev_examples, dataloader=dev_dataloader)
     print('Evaluating on test set...')
     export_predictions(args, 'test', examples=test_examples, dataloader=test_dataloader)
 
-if args.do_evalc:
+if args.do_evalc and (is_main_process or args.optimize_on_cpu):
     print('Evaluating on devc set...')
     export_predictions(args, 'devc')
-    os.system(f'cat {args.output_dir}/logits_devc?.txt > {args.output_dir}/logits_devc.txt')
+    if is_main_process:
+        concat_files(os.path.join(args.output_dir, "logits_devc?.txt"), os.path.join(args.output_dir, "logits_devc.txt"))
     print('Evaluating on testc set...')
     export_predictions(args, 'testc')
-    os.system(f'cat {args.output_dir}/logits_testc?.txt > {args.output_dir}/logits_devc.txt')
\ No newline at end of file
+    if is_main_process:
+        concat_files(os.path.join(args.output_dir, "logits_testc?.txt"), os.path.join(args.output_dir, "logits_testc.txt"))
\ No newline at end of file